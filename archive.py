@@ -0,0 +1,251 @@
+import os
+import time
+import threading
+import subprocess
+import zipfile
+from datetime import datetime
+from settings import SAVE_DIR, TIME_LAPSE_DIR
+from db_settings import get_setting
+
+# Compacted captures live in one zip per day, e.g. pictures/archive/20250131.zip
+ARCHIVE_SUBDIR = 'archive'
+# Limits per compaction run so a backlog is worked off over several runs
+COMPACT_MAX_FILES_PER_RUN = 500
+COMPACT_PAUSE_SECONDS = 0.02
+
+# Cached archive index per directory: (signature, {filename: (zip_path, ZipInfo)})
+_index_cache = {}
+_index_lock = threading.Lock()
+# Held only while a day archive is rewritten and swapped in, so compaction and deletes
+# never rewrite the same zip at once
+_write_lock = threading.Lock()
+# Paths compaction could not decode or re-encode; they are left in place and skipped from
+# then on so they don't keep cleanup waiting for compaction
+_gave_up = set()
+# The one background compaction thread, if running
+_compaction_thread = None
+_compaction_lock = threading.Lock()
+
+def archive_dir(directory):
+    return os.path.join(directory, ARCHIVE_SUBDIR)
+
+def _lower_priority():
+    """Drop the calling thread to the lowest CPU and I/O priority"""
+    tid = threading.get_native_id()
+    try:
+        os.setpriority(os.PRIO_PROCESS, tid, 19)
+        subprocess.run(['ionice', '-c', '3', '-p', str(tid)], capture_output=True, check=False)
+    except OSError as e:
+        print(f"Could not lower compaction priority: {e}")
+
+def start_compaction(directories=None):
+    """Compact directories (default: motion and timelapse) in a background thread at idle priority.
+
+    Returns immediately; does nothing and returns False if a compaction is already running.
+    """
+    global _compaction_thread
+    if directories is None:
+        directories = (SAVE_DIR, TIME_LAPSE_DIR)
+
+    def target():
+        _lower_priority()
+        for directory in directories:
+            try:
+                compact_directory(directory)
+            except Exception as e:
+                print(f"Error compacting {directory}: {e}")
+
+    with _compaction_lock:
+        if _compaction_thread is not None and _compaction_thread.is_alive():
+            return False
+        _compaction_thread = threading.Thread(target=target, daemon=True)
+        _compaction_thread.start()
+    return True
+
+def compaction_running():
+    return _compaction_thread is not None and _compaction_thread.is_alive()
+
+def compaction_cutoff(older_than_days=None):
+    """Files last modified before this timestamp are due for compaction"""
+    if older_than_days is None:
+        older_than_days = get_setting('COMPACT_AFTER_DAYS', 7)
+    return time.time() - older_than_days * 86400
+
+def compaction_gave_up(path):
+    """True if compaction failed on this file before and leaves it alone"""
+    return path in _gave_up
+
+def compact_directory(directory, older_than_days=None, quality=None):
+    """Re-encode JPEGs older than older_than_days at half resolution into per-day archives"""
+    if quality is None:
+        quality = get_setting('COMPACT_JPEG_QUALITY', 60)
+    cutoff = compaction_cutoff(older_than_days)
+    by_day = {}
+    count = 0
+    for f in sorted(os.listdir(directory)):
+        if not f.endswith('.jpg'):
+            continue
+        path = os.path.join(directory, f)
+        if path in _gave_up:
+            continue
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            continue
+        if mtime < cutoff:
+            day = time.strftime('%Y%m%d', time.localtime(mtime))
+            by_day.setdefault(day, []).append((f, path, mtime))
+            count += 1
+            if count >= COMPACT_MAX_FILES_PER_RUN:
+                break
+    compacted = 0
+    for day, files in sorted(by_day.items()):
+        compacted += _compact_day(directory, day, files, quality)
+    return compacted
+
+def archive_names(zip_path):
+    """Names of the images in a day archive, empty if it can't be read"""
+    try:
+        with zipfile.ZipFile(zip_path) as zf:
+            return set(zf.namelist())
+    except (OSError, zipfile.BadZipFile):
+        return set()
+
+def _compact_day(directory, day, files, quality):
+    import cv2
+    os.makedirs(archive_dir(directory), exist_ok=True)
+    zip_path = os.path.join(archive_dir(directory), f"{day}.zip")
+    new_path = zip_path + '.new'
+    tmp_path = zip_path + '.tmp'
+    existing = archive_names(zip_path)
+    archived = []
+    try:
+        # Re-encode into a side file first; this is the slow part and takes no lock
+        with zipfile.ZipFile(new_path, 'w', zipfile.ZIP_STORED) as new:
+            for name, path, mtime in files:
+                if name in existing:
+                    # Already archived by an earlier run that stopped before deleting the original
+                    archived.append(path)
+                    continue
+                # Decoding at half size is much cheaper than a full decode plus resize
+                img = cv2.imread(path, cv2.IMREAD_REDUCED_COLOR_2)
+                if img is None:
+                    print(f"Could not read {path}, leaving it in place")
+                    _gave_up.add(path)
+                    continue
+                ok, buf = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+                if not ok:
+                    print(f"Could not re-encode {path}, leaving it in place")
+                    _gave_up.add(path)
+                    continue
+                new.writestr(zipfile.ZipInfo(name, date_time=time.localtime(mtime)[:6]), buf.tobytes())
+                archived.append(path)
+                time.sleep(COMPACT_PAUSE_SECONDS)
+        if not archived:
+            return 0
+        with _write_lock:
+            # Merge into a new day archive and swap it in, so a crash never leaves a broken zip
+            with open(tmp_path, 'wb') as fh:
+                with zipfile.ZipFile(fh, 'w', zipfile.ZIP_STORED) as out:
+                    merged = set()
+                    if os.path.exists(zip_path):
+                        with zipfile.ZipFile(zip_path) as old:
+                            for info in old.infolist():
+                                out.writestr(info, old.read(info))
+                                merged.add(info.filename)
+                    with zipfile.ZipFile(new_path) as new:
+                        for info in new.infolist():
+                            if info.filename not in merged:
+                                out.writestr(info, new.read(info))
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(tmp_path, zip_path)
+    finally:
+        if os.path.exists(new_path):
+            os.remove(new_path)
+    # Originals are only removed once the archive holding them is in place
+    for path in archived:
+        try:
+            os.remove(path)
+        except OSError as e:
+            print(f"Error deleting {path}: {e}")
+    if archived:
+        print(f"Compacted {len(archived)} files into {zip_path}")
+    return len(archived)
+
+def _archive_index(directory):
+    """Map archived filename -> (zip path, ZipInfo), rebuilt only when an archive changes"""
+    adir = archive_dir(directory)
+    try:
+        signature = tuple((f, os.path.getmtime(os.path.join(adir, f)))
+                          for f in sorted(os.listdir(adir)) if f.endswith('.zip'))
+    except FileNotFoundError:
+        return {}
+    with _index_lock:
+        cached = _index_cache.get(directory)
+        if cached and cached[0] == signature:
+            return cached[1]
+        index = {}
+        for f, _ in signature:
+            zip_path = os.path.join(adir, f)
+            try:
+                with zipfile.ZipFile(zip_path) as zf:
+                    for info in zf.infolist():
+                        index[info.filename] = (zip_path, info)
+            except (OSError, zipfile.BadZipFile) as e:
+                print(f"Error reading archive {zip_path}: {e}")
+        _index_cache[directory] = (signature, index)
+        return index
+
+def list_archived(directory):
+    """Archived images as dicts with name, size and mtime, like the gallery listings"""
+    return [{'name': name, 'size': info.file_size, 'mtime': datetime(*info.date_time)}
+            for name, (_, info) in _archive_index(directory).items()]
+
+def read_archived(directory, filename):
+    """Return the bytes of an archived image, or None if it is not in any archive"""
+    entry = _archive_index(directory).get(filename)
+    if entry is None:
+        return None
+    zip_path, info = entry
+    try:
+        with zipfile.ZipFile(zip_path) as zf:
+            return zf.read(info.filename)
+    except (OSError, KeyError, zipfile.BadZipFile):
+        return None
+
+def delete_archived(directory, filename):
+    """Remove one image from its day archive, returns False if it was not archived"""
+    entry = _archive_index(directory).get(filename)
+    if entry is None:
+        return False
+    zip_path, _ = entry
+    tmp_path = zip_path + '.tmp'
+    with _write_lock:
+        with zipfile.ZipFile(zip_path) as old:
+            remaining = [info for info in old.infolist() if info.filename != filename]
+            if remaining:
+                with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_STORED) as out:
+                    for info in remaining:
+                        out.writestr(info, old.read(info))
+        if remaining:
+            os.replace(tmp_path, zip_path)
+        else:
+            os.remove(zip_path)
+    return True
+
+def archive_files(directory):
+    """(day timestamp, zip path) for every day archive in directory"""
+    adir = archive_dir(directory)
+    try:
+        names = [f for f in os.listdir(adir) if f.endswith('.zip')]
+    except FileNotFoundError:
+        return []
+    files = []
+    for f in names:
+        try:
+            day = time.mktime(time.strptime(f[:-len('.zip')], '%Y%m%d'))
+        except ValueError:
+            continue
+        files.append((day, os.path.join(adir, f)))
+    return files
@@ -0,0 +1,237 @@
+"""Load-test the web tier against synthetic archives.
+
+Generates SAVE_DIR and TIME_LAPSE_DIR trees of the given sizes in a temp directory,
+serves the Flask app without a camera in a separate process and drives each route with
+concurrent clients. Results (p50/p99 latency, throughput, and the server's RSS at the
+start of and peak during each route, plus the time of the stats history sample that
+/stats serves) are written as JSON.
+
+    python benchmarks/web_load.py --sizes 1000,10000,100000 --output bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+def stub_camera():
+    """Make picamera2 importable without hardware; the benchmark never starts the detector"""
+    class Picamera2:
+        def __init__(self, *args, **kwargs):
+            raise RuntimeError("Camera is stubbed out in the benchmark")
+
+    sys.modules['picamera2'] = types.SimpleNamespace(Picamera2=Picamera2)
+
+def sample_jpeg():
+    """A small real JPEG, so routes that decode images do representative work"""
+    import cv2
+    import numpy as np
+    ok, buf = cv2.imencode('.jpg', np.full((96, 128, 3), 128, dtype=np.uint8))
+    return buf.tobytes()
+
+def generate_tree(directory, prefix, count):
+    """Create count timestamped JPEGs, one per minute going back from now"""
+    os.makedirs(directory, exist_ok=True)
+    data = sample_jpeg()
+    now = time.time()
+    names = []
+    for i in range(count):
+        mtime = now - i * 60
+        name = f"{prefix}_{time.strftime('%Y%m%d-%H%M%S', time.localtime(mtime))}.jpg"
+        path = os.path.join(directory, name)
+        with open(path, 'wb') as fh:
+            fh.write(data)
+        os.utime(path, (mtime, mtime))
+        names.append(name)
+    return names
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+class RssSampler:
+    """Track the resident set size of the server process while a route is being driven"""
+
+    def __init__(self, pid, interval=0.01):
+        import psutil
+        self.process = psutil.Process(pid)
+        self.interval = interval
+        self.start = 0
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.process.memory_info().rss)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.start = self.peak = self.process.memory_info().rss
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+def fetch(url, timeout):
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            response.read()
+            ok = response.status == 200
+    except Exception:
+        ok = False
+    return time.perf_counter() - started, ok
+
+def drive_route(base_url, server_pid, path, requests, concurrency, timeout):
+    """Issue requests to path from concurrency clients and summarize the latencies"""
+    url = base_url + path
+    fetch(url, timeout)  # Warm-up, not measured
+    with RssSampler(server_pid) as sampler:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(lambda _: fetch(url, timeout), range(requests)))
+        elapsed = time.perf_counter() - started
+    latencies = sorted(latency for latency, _ in results)
+    return {
+        'requests': requests,
+        'errors': sum(1 for _, ok in results if not ok),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'throughput_rps': requests / elapsed if elapsed else None,
+        'start_rss_mb': sampler.start / (1024**2),
+        'peak_rss_mb': sampler.peak / (1024**2),
+    }
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=REPO_DIR,
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def serve(root):
+    """Server process: serve the app on a free port, then take a stats sample per line on stdin.
+
+    The port and each sample's duration in seconds are written to stdout, one per line;
+    everything the app prints goes to stderr.
+    """
+    os.environ['SAVE_DIR'] = os.path.join(root, 'pictures')
+    os.environ['TIME_LAPSE_DIR'] = os.path.join(root, 'timelapse')
+    stub_camera()
+    control, sys.stdout = sys.stdout, sys.stderr
+
+    import db_settings
+    db_settings.DB_PATH = os.path.join(root, 'settings.db')
+    import history
+    history.history.path = os.path.join(root, 'history.bin')
+    from gevent import get_hub
+    from webserver import make_server
+
+    server = make_server('127.0.0.1', 0)
+    server.start()
+    print(server.server_port, file=control, flush=True)
+    # Blocking calls go through the hub's thread pool so the server keeps running meanwhile
+    pool = get_hub().threadpool
+    while pool.apply(sys.stdin.readline):
+        started = time.perf_counter()
+        pool.apply(history.history.sample, kwds={'rescan': True})
+        print(time.perf_counter() - started, file=control, flush=True)
+    server.stop()
+
+def run(sizes, requests, concurrency, timeout):
+    root = tempfile.mkdtemp(prefix='pimocam-bench-')
+    save_dir = os.path.join(root, 'pictures')
+    timelapse_dir = os.path.join(root, 'timelapse')
+    # The server runs in its own process so its RSS isn't mixed up with the client threads'
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', root],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    base_url = f"http://127.0.0.1:{int(server.stdout.readline())}"
+
+    report = {
+        'benchmark': 'web_load',
+        'revision': git_revision(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'requests_per_route': requests,
+        'concurrency': concurrency,
+        # Seconds per size for the stats history sample, which is not a route
+        'history_sample_seconds': {},
+        'results': [],
+    }
+    try:
+        for size in sizes:
+            # Fresh trees per size so earlier runs don't skew the directory scans
+            for directory in (save_dir, timelapse_dir):
+                shutil.rmtree(directory, ignore_errors=True)
+            motion = generate_tree(save_dir, 'motion', size)
+            generate_tree(timelapse_dir, 'timelapse', size)
+            # /stats serves the latest history sample, so refresh it for the new trees
+            server.stdin.write('sample\n')
+            server.stdin.flush()
+            elapsed = float(server.stdout.readline())
+            report['history_sample_seconds'][size] = elapsed
+            print(f"{size:>7} files  {'history_sample':<11} {elapsed * 1000:9.1f} ms", file=sys.stderr)
+            routes = {
+                'index': '/',
+                'timelapse': '/timelapse',
+                'view_image': f"/view/{motion[len(motion) // 2]}",
+                'images': '/images',
+                'stats': '/stats',
+            }
+            for route, path in routes.items():
+                result = drive_route(base_url, server.pid, path, requests, concurrency, timeout)
+                result.update({'files': size, 'route': route})
+                report['results'].append(result)
+                print(f"{size:>7} files  {route:<11} p50 {result['p50_ms']:9.1f} ms  "
+                      f"p99 {result['p99_ms']:9.1f} ms  {result['throughput_rps']:8.1f} req/s  "
+                      f"rss {result['start_rss_mb']:7.1f} -> {result['peak_rss_mb']:7.1f} MB  "
+                      f"errors {result['errors']}", file=sys.stderr)
+    finally:
+        server.stdin.close()
+        server.wait(timeout=30)
+        shutil.rmtree(root, ignore_errors=True)
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='Comma-separated number of files per directory (default: %(default)s)')
+    parser.add_argument('--requests', type=int, default=20, help='Requests per route (default: %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=8, help='Concurrent clients (default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=300, help='Per-request timeout in seconds (default: %(default)s)')
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+    parser.add_argument('--serve', metavar='ROOT', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve)
+        return
+
+    sizes = [int(s) for s in args.sizes.split(',') if s]
+    report = run(sizes, args.requests, args.concurrency, args.timeout)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
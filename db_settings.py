@@ -1,9 +1,14 @@
 import sqlite3
 import os
+import threading
 from contextlib import contextmanager
 
 DB_PATH = os.path.join(os.path.dirname(__file__), 'settings.db')
 
+# The schema is created on first use rather than at import time
+_db_initialized = False
+_db_init_lock = threading.Lock()
+
 # Settings metadata with defaults, descriptions, and validation
 SETTINGS_METADATA = {
     'CONTOUR_THRESHOLD': {
@@ -46,6 +51,28 @@ SETTINGS_METADATA = {
         'description': 'Minimum seconds between motion captures to avoid duplicate photos.',
         'category': 'Motion Detection'
     },
+    'ADAPTIVE_THRESHOLD': {
+        'value': False,
+        'type': 'bool',
+        'description': 'Scale the threshold with measured sensor noise and scene brightness. Cuts false triggers at dusk and night.',
+        'category': 'Motion Detection'
+    },
+    'NOISE_ADAPT_FRAMES': {
+        'value': 50,
+        'type': 'int',
+        'min': 5,
+        'max': 1000,
+        'description': 'Number of frames the adaptive noise estimate averages over. Higher = slower to adapt to lighting changes.',
+        'category': 'Motion Detection'
+    },
+    'NOISE_SIGMA': {
+        'value': 4.0,
+        'type': 'float',
+        'min': 1.0,
+        'max': 10.0,
+        'description': 'Standard deviations above the noise floor a pixel must change to count as motion (adaptive mode only).',
+        'category': 'Motion Detection'
+    },
     'TIMELAPSE_BRIGHTNESS_THRESHOLD': {
         'value': 40,
         'type': 'int',
@@ -67,7 +94,23 @@ SETTINGS_METADATA = {
         'type': 'float',
         'min': 0.5,
         'max': 100.0,
-        'description': 'Minimum free disk space in GB. Old files are deleted when space is low.',
+        'description': 'Minimum free disk space in GB. Old files are compacted, then deleted, when space is low.',
+        'category': 'Storage'
+    },
+    'COMPACT_AFTER_DAYS': {
+        'value': 7,
+        'type': 'int',
+        'min': 1,
+        'max': 365,
+        'description': 'Captures older than this many days are re-encoded at half resolution and packed into one archive per day.',
+        'category': 'Storage'
+    },
+    'COMPACT_JPEG_QUALITY': {
+        'value': 60,
+        'type': 'int',
+        'min': 20,
+        'max': 95,
+        'description': 'JPEG quality used when compacting old captures.',
         'category': 'Storage'
     },
     'WEBSERVER_PORT': {
@@ -92,13 +135,23 @@ def get_db():
     conn = sqlite3.connect(DB_PATH)
     conn.row_factory = sqlite3.Row
     try:
+        if not _db_initialized:
+            _init_schema(conn)
         yield conn
     finally:
         conn.close()
 
 def init_db():
     """Initialize database with settings table and default values"""
-    with get_db() as conn:
+    with get_db():
+        pass
+
+def _init_schema(conn):
+    """Create the settings table and insert missing defaults, once per process"""
+    global _db_initialized
+    with _db_init_lock:
+        if _db_initialized:
+            return
         cursor = conn.cursor()
         
         # Create settings table
@@ -114,27 +167,30 @@ def init_db():
             )
         ''')
         
-        # Check if table is empty
-        cursor.execute('SELECT COUNT(*) FROM settings')
-        count = cursor.fetchone()[0]
-        
-        # Populate with defaults if empty
-        if count == 0:
-            for key, meta in SETTINGS_METADATA.items():
-                cursor.execute('''
-                    INSERT INTO settings (key, value, data_type, min_value, max_value, description, category)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    key,
-                    str(meta['value']),
-                    meta['type'],
-                    meta.get('min'),
-                    meta.get('max'),
-                    meta.get('description', ''),
-                    meta.get('category', 'General')
-                ))
+        # Add any settings missing from the table (new installs and newly added settings)
+        cursor.execute('SELECT key FROM settings')
+        existing = {row[0] for row in cursor.fetchall()}
+        added = 0
+        for key, meta in SETTINGS_METADATA.items():
+            if key in existing:
+                continue
+            cursor.execute('''
+                INSERT INTO settings (key, value, data_type, min_value, max_value, description, category)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                key,
+                str(meta['value']),
+                meta['type'],
+                meta.get('min'),
+                meta.get('max'),
+                meta.get('description', ''),
+                meta.get('category', 'General')
+            ))
+            added += 1
+        if added:
             conn.commit()
-            print("Database initialized with default settings")
+            print(f"Database initialized with {added} default settings")
+        _db_initialized = True
 
 def get_setting(key, default=None):
     """Get a setting value by key, with type conversion"""
@@ -238,6 +294,3 @@ def reset_to_defaults():
         for key, meta in SETTINGS_METADATA.items():
             cursor.execute('UPDATE settings SET value = ? WHERE key = ?', (str(meta['value']), key))
         conn.commit()
-
-# Initialize database on module import
-init_db()
@@ -0,0 +1,51 @@
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+# Recent events kept for clients reconnecting with Last-Event-ID
+EVENT_HISTORY = 100
+
+class EventBus:
+    """In-process publish/subscribe for server-sent events.
+
+    Events go into one shared bounded ring buffer, recorded even with no subscribers so
+    a client reconnecting with Last-Event-ID catches up. Subscribers don't block a thread
+    waiting: each registers a wake-up callback, which publish calls from the publishing
+    thread, so it has to be thread-safe and return immediately.
+    """
+
+    def __init__(self, history=EVENT_HISTORY):
+        self._events = deque(maxlen=history)
+        self._lock = threading.Lock()
+        self._wakers = []
+        self.last_id = 0
+
+    @property
+    def subscribers(self):
+        return len(self._wakers)
+
+    def publish(self, event_type, **data):
+        with self._lock:
+            self.last_id += 1
+            self._events.append((self.last_id, event_type, data))
+            wakers = list(self._wakers)
+        for wake in wakers:
+            wake()
+
+    @contextmanager
+    def subscribe(self, wake):
+        with self._lock:
+            self._wakers.append(wake)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._wakers.remove(wake)
+
+    def since(self, after_id):
+        """Events newer than after_id, oldest first"""
+        with self._lock:
+            return [event for event in self._events if event[0] > after_id]
+
+# Global instance
+bus = EventBus()
@@ -0,0 +1,189 @@
+import os
+import time
+import shutil
+import threading
+from datetime import datetime
+from motion_detection import detector
+from archive import list_archived, archive_files
+
+HISTORY_PATH = os.path.join(os.path.dirname(__file__), 'history.bin')
+SAMPLE_INTERVAL_SECONDS = 60
+# Image counts and archive size need a full directory scan, so they are refreshed less often
+SUMMARY_INTERVAL_SECONDS = 900
+
+# (metric, how samples are combined into a bucket)
+METRICS = [
+    ('motion_events', 'sum'),
+    ('detection_fps', 'mean'),
+    ('loop_latency_ms', 'mean'),
+    ('disk_free_gb', 'mean'),
+    ('cpu_percent', 'mean'),
+    ('cpu_temp_c', 'mean'),
+    ('archive_mb', 'mean'),
+]
+
+# (tier, bucket seconds, slots): a day of minutes, a week of quarter hours, 90 days of hours
+TIERS = [
+    ('minute', 60, 1440),
+    ('quarter', 900, 672),
+    ('hour', 3600, 2160),
+]
+
+def cpu_temperature():
+    """CPU temperature in degrees C, or None where psutil can't read sensors"""
+    import psutil
+    try:
+        temps = psutil.sensors_temperatures()
+    except (AttributeError, OSError):
+        return None
+    for name in ('cpu_thermal', 'cpu-thermal', 'coretemp'):
+        if temps.get(name):
+            return temps[name][0].current
+    for entries in temps.values():
+        if entries:
+            return entries[0].current
+    return None
+
+def directory_summary(directory):
+    """Image count and size in MB for a capture directory, archived images included"""
+    count = 0
+    size = 0
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.endswith('.jpg') and entry.is_file():
+                count += 1
+                size += entry.stat().st_size
+    count += len(list_archived(directory))
+    for _, path in archive_files(directory):
+        try:
+            size += os.path.getsize(path)
+        except OSError:
+            pass
+    return {'count': count, 'size_mb': size / (1024**2)}
+
+class StatsHistory:
+    """Round-robin time series for detector and system stats in one fixed-size file.
+
+    Each tier is a ring of rows [bucket_start, *counts, *metrics], with a sample count
+    per metric so missing values don't dilute the means. A sample goes to
+    slot (timestamp // bucket) % slots of every tier, so there is no head pointer and
+    the file never grows; a row whose bucket_start doesn't match is stale and reset.
+    """
+
+    def __init__(self, path=HISTORY_PATH):
+        self.path = path
+        self.latest = None
+        self._data = None
+        self._lock = threading.Lock()
+        self._sample_lock = threading.Lock()
+        self._last_loop = None
+        self._last_sampled = None
+        self._summaries = None
+        self._summarized = None
+        self._offsets = {}
+        rows = 0
+        for name, _, slots in TIERS:
+            self._offsets[name] = rows
+            rows += slots
+        self._shape = (rows, 1 + 2 * len(METRICS))
+
+    def _open(self):
+        # numpy is imported here to keep it off the startup path
+        import numpy as np
+        if self._data is None:
+            size = self._shape[0] * self._shape[1] * 8
+            # Reuse the file if the layout matches, otherwise start a fresh history
+            mode = 'r+' if os.path.exists(self.path) and os.path.getsize(self.path) == size else 'w+'
+            self._data = np.memmap(self.path, dtype=np.float64, mode=mode, shape=self._shape)
+        return self._data
+
+    def add(self, timestamp, values):
+        """Fold one sample into every tier; missing or None values are ignored"""
+        import numpy as np
+        sample = np.array([np.nan if values.get(name) is None else values[name] for name, _ in METRICS],
+                          dtype=np.float64)
+        is_sum = np.array([kind == 'sum' for _, kind in METRICS])
+        present = ~np.isnan(sample)
+        n = len(METRICS)
+        with self._lock:
+            data = self._open()
+            for name, bucket, slots in TIERS:
+                start = timestamp - timestamp % bucket
+                row = data[self._offsets[name] + int(timestamp // bucket) % slots]
+                if row[0] != start:
+                    row[0] = start
+                    row[1:1 + n] = present
+                    row[1 + n:] = sample
+                    continue
+                counts = row[1:1 + n] + present
+                current = row[1 + n:]
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    merged = np.where(is_sum, current + sample, current + (sample - current) / counts)
+                merged = np.where(present, np.where(np.isnan(current), sample, merged), current)
+                row[1:1 + n] = counts
+                row[1 + n:] = merged
+            data.flush()
+
+    def query(self, tier, since=None):
+        """Points of a tier as [bucket_start, *metrics] lists, oldest first, None for missing values"""
+        import numpy as np
+        bucket, slots = next((b, n) for name, b, n in TIERS if name == tier)
+        offset = self._offsets[tier]
+        with self._lock:
+            rows = np.array(self._open()[offset:offset + slots])
+        # Drop empty rows and rows left over from more than one full ring ago
+        cutoff = time.time() - bucket * slots
+        if since is not None:
+            cutoff = max(cutoff, since)
+        rows = rows[rows[:, 0] > cutoff]
+        rows = rows[np.argsort(rows[:, 0])]
+        values = rows[:, 1 + len(METRICS):]
+        return [[float(start)] + [None if np.isnan(v) else float(v) for v in row]
+                for start, row in zip(rows[:, 0], values)]
+
+    def sample(self, rescan=False):
+        """Take a sample now, store it and cache it as the latest snapshot for the stats page.
+
+        rescan forces the directory summaries to be refreshed regardless of their age.
+        """
+        import psutil
+        with self._sample_lock:
+            now = time.time()
+            sampled = time.monotonic()
+            loop = dict(detector.loop_stats)
+            values = {}
+            if self._last_loop is not None:
+                elapsed = sampled - self._last_sampled
+                frames = loop['frames'] - self._last_loop['frames']
+                values['motion_events'] = loop['motion_events'] - self._last_loop['motion_events']
+                values['detection_fps'] = frames / elapsed if elapsed > 0 else None
+                if frames:
+                    busy = loop['busy_seconds'] - self._last_loop['busy_seconds']
+                    values['loop_latency_ms'] = busy / frames * 1000
+            self._last_loop = loop
+            self._last_sampled = sampled
+
+            disk = shutil.disk_usage('/')
+            values['disk_free_gb'] = disk.free / (1024**3)
+            values['cpu_percent'] = psutil.cpu_percent(interval=None)
+            values['cpu_temp_c'] = cpu_temperature()
+            # Between scans the stats page shows the last summaries and archive_mb is left out
+            if rescan or self._summaries is None or sampled - self._summarized >= SUMMARY_INTERVAL_SECONDS:
+                self._summaries = (directory_summary(detector.save_dir),
+                                   directory_summary(detector.timelapse_dir))
+                self._summarized = sampled
+                values['archive_mb'] = sum(summary['size_mb'] for summary in self._summaries)
+            motion, timelapse = self._summaries
+            self.add(now, values)
+            self.latest = {
+                'time': datetime.fromtimestamp(now),
+                'values': values,
+                'motion': motion,
+                'timelapse': timelapse,
+                'free_space_gb': disk.free / (1024**3),
+                'total_space_gb': disk.total / (1024**3),
+            }
+            return self.latest
+
+# Global instance
+history = StatsHistory()
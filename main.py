@@ -1,24 +1,26 @@
 import time
 from datetime import datetime
 from motion_detection import detector, scheduler, sync_to_gdrive
-from webserver import app
+from history import history, SAMPLE_INTERVAL_SECONDS
+from webserver import make_server
 from settings import WEBSERVER_HOST
 from db_settings import get_setting
 
 if __name__ == '__main__':
-    # Start motion detection
+    # Start motion detection, the camera warms up in the background
     detector.start()
     scheduler_interval = get_setting('SCHEDULER_INTERVAL_MINUTES', 30)
     # Run timelapse immediately at startup, then repeat every interval
     scheduler.add_job(func=lambda: detector.capture_timelapse(), trigger="interval", minutes=scheduler_interval, next_run_time=datetime.now())
     scheduler.add_job(func=sync_to_gdrive, trigger="interval", hours=1)
+    # Sample detector and system stats for /stats and /api/stats/history
+    scheduler.add_job(func=history.sample, trigger="interval", seconds=SAMPLE_INTERVAL_SECONDS, next_run_time=datetime.now())
     scheduler.start()
     print(f"Scheduler started - timelapse will run immediately and then every {scheduler_interval} minutes")
     try:
         # Run webserver
         port = get_setting('WEBSERVER_PORT', 5000)
-        # Disable debug mode to prevent Flask reloader from conflicting with camera
-        app.run(host=WEBSERVER_HOST, port=port, debug=False)
+        make_server(WEBSERVER_HOST, port).serve_forever()
     except KeyboardInterrupt:
         print("Shutting down...")
     finally:
@@ -1,6 +1,3 @@
-import cv2
-import numpy as np
-from picamera2 import Picamera2
 import time
 import os
 import threading
@@ -9,30 +6,93 @@ import subprocess
 from apscheduler.schedulers.background import BackgroundScheduler
 from settings import SAVE_DIR, MAIN_RES, LORES_RES, TIME_LAPSE_DIR
 from db_settings import get_setting
+from archive import (ARCHIVE_SUBDIR, start_compaction, compaction_cutoff, compaction_gave_up, archive_files,
+                     archive_names)
+from events import bus
+
+# Adaptive thresholding: dark scenes produce smaller diffs for real motion, so the
+# configured THRESH_VALUE is scaled down with brightness, but never below this fraction
+ADAPTIVE_MIN_SCALE = 0.4
+ADAPTIVE_REFERENCE_BRIGHTNESS = 128.0
+
+# Camera warm-up: wait until exposure * gain changes by less than the tolerance for
+# a few consecutive frames (or the sensor reports AE locked), capped by the timeout
+WARMUP_TIMEOUT_SECONDS = 5.0
+WARMUP_SETTLE_TOLERANCE = 0.05
+WARMUP_SETTLE_FRAMES = 3
+
+# Under disk pressure, deletion waits for compaction unless free space is below this
+# fraction of MIN_FREE_GB
+CLEANUP_EMERGENCY_FRACTION = 0.5
 
 def cleanup_old_files(directory, min_free_gb=None):
-    """Delete oldest files in directory if free disk space is below min_free_gb"""
+    """Free disk space in directory when it drops below min_free_gb.
+
+    Old captures are compacted into day archives in the background first. The oldest
+    files (loose JPEGs and whole day archives) are only deleted when nothing is left
+    to compact (files compaction failed on don't count), or when free space falls
+    below the emergency floor.
+    """
     if min_free_gb is None:
         min_free_gb = get_setting('MIN_FREE_GB', 10.0)
     free_gb = shutil.disk_usage('/').free / (1024**3)
-    if free_gb < min_free_gb:
-        files = [os.path.join(directory, f) for f in os.listdir(directory) if f.endswith('.jpg')]
-        files.sort(key=os.path.getmtime)  # Oldest first
-        while files and free_gb < min_free_gb:
-            oldest = files.pop(0)
-            try:
-                os.remove(oldest)
-                print(f"Deleted old file: {oldest}")
-                free_gb = shutil.disk_usage('/').free / (1024**3)
-            except OSError as e:
-                print(f"Error deleting {oldest}: {e}")
+    if free_gb >= min_free_gb:
+        return
+    files = []
+    for f in os.listdir(directory):
+        if not f.endswith('.jpg'):
+            continue
+        path = os.path.join(directory, f)
+        try:
+            files.append((os.path.getmtime(path), path))
+        except OSError:
+            continue  # Removed by compaction in the meantime
+    cutoff = compaction_cutoff()
+    compactable = any(mtime < cutoff and not compaction_gave_up(path) for mtime, path in files)
+    if compactable and free_gb >= min_free_gb * CLEANUP_EMERGENCY_FRACTION:
+        start_compaction([directory])
+        return
+    files += archive_files(directory)
+    files.sort()  # Oldest first
+    while files and free_gb < min_free_gb:
+        _, oldest = files.pop(0)
+        # A day archive takes all its images with it
+        names = [os.path.basename(oldest)] if oldest.endswith('.jpg') else sorted(archive_names(oldest))
+        try:
+            os.remove(oldest)
+            print(f"Deleted old file: {oldest}")
+            for name in names:
+                publish_deleted(directory, name)
+            free_gb = shutil.disk_usage('/').free / (1024**3)
+        except OSError as e:
+            print(f"Error deleting {oldest}: {e}")
+
+def gallery_of(directory):
+    """'timelapse' for the timelapse directory, 'motion' otherwise"""
+    return 'timelapse' if os.path.abspath(directory) == os.path.abspath(TIME_LAPSE_DIR) else 'motion'
+
+def publish_deleted(directory, name):
+    bus.publish('deleted', gallery=gallery_of(directory), name=name)
+
+def publish_file(event_type, filename, **extra):
+    """Publish a new capture with the fields the gallery cards show"""
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return
+    bus.publish(event_type, name=os.path.basename(filename), size=stat.st_size,
+                mtime=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stat.st_mtime)), **extra)
 
 def sync_to_gdrive():
+    # copy rather than sync, so the drive keeps the full-resolution originals after they are
+    # compacted or deleted for space here; the lossy day archives are not uploaded
     try:
         # Sync pictures
-        result1 = subprocess.run(['rclone', 'sync', SAVE_DIR, 'GDrive:/PiMotion/pictures', '--log-level', 'INFO'], check=True)
+        result1 = subprocess.run(['rclone', 'copy', SAVE_DIR, 'GDrive:/PiMotion/pictures',
+                                  '--exclude', f'{ARCHIVE_SUBDIR}/**', '--log-level', 'INFO'], check=True)
         # Sync timelapse
-        result2 = subprocess.run(['rclone', 'sync', TIME_LAPSE_DIR, 'GDrive:/PiMotion/timelapse', '--log-level', 'INFO'], check=True)
+        result2 = subprocess.run(['rclone', 'copy', TIME_LAPSE_DIR, 'GDrive:/PiMotion/timelapse',
+                                  '--exclude', f'{ARCHIVE_SUBDIR}/**', '--log-level', 'INFO'], check=True)
         print("Synced to Google Drive")
     except subprocess.CalledProcessError as e:
         print(f"Sync error: {e}")
@@ -50,46 +110,148 @@ class MotionDetector:
         self.frame1 = None
         self.thread = None
         self.last_capture = 0
+        # 'stopped', 'warming_up', 'running' or 'error'
+        self.state = 'stopped'
+        self.error = None
+        self.warmup_seconds = None
+        self.camera_ready = threading.Event()
+        # Per-pixel running noise estimate of the frame diff (adaptive mode)
+        self.noise_mean = None
+        self.noise_var = None
+        # When a static-threshold detector would next be allowed to write (its cooldown)
+        self.static_cooldown_until = 0.0
+        self.adaptive_stats = {
+            'frames': 0,
+            'triggers': 0,
+            'false_triggers_avoided': 0,
+            'adaptive_only_triggers': 0,
+            'avg_capture_bytes': 0,
+        }
+        # Running totals sampled by the stats history (busy_seconds excludes the sleeps)
+        self.loop_stats = {'frames': 0, 'motion_events': 0, 'busy_seconds': 0.0}
 
     def start(self):
+        """Start the camera warm-up and detection loop in the background"""
         if self.running:
             return
         self.running = True
+        self.error = None
+        self.camera_ready.clear()
+        self._set_state('warming_up')
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        started = time.monotonic()
         try:
+            # cv2 and picamera2 are slow to import, keep them off the startup path
+            import cv2
+            from picamera2 import Picamera2
             self.picam2 = Picamera2()
             config = self.picam2.create_preview_configuration(main={"size": MAIN_RES, "format": "RGB888"}, lores={"size": LORES_RES})
             self.picam2.configure(config)
             self.picam2.start()
-            time.sleep(2)
+            settled = self._wait_for_exposure()
             # Capture first frame
             frame1_yuv = self.picam2.capture_array("lores")
             frame1_color = cv2.cvtColor(frame1_yuv, cv2.COLOR_YUV2RGB_I420)
             self.frame1 = cv2.cvtColor(frame1_color, cv2.COLOR_BGR2GRAY)
             blur_size = get_setting('BLUR_KERNEL', 15)
             self.frame1 = cv2.GaussianBlur(self.frame1, (blur_size, blur_size), 0)
-            print("Motion detection started.")
-            self.thread = threading.Thread(target=self._detect_loop)
-            self.thread.start()
-        except RuntimeError as e:
+        except Exception as e:
             print(f"Failed to start camera: {e}")
-            self.running = False
+            self._fail(e)
+            return
+        self.warmup_seconds = time.monotonic() - started
+        if not self.running:
+            # stop() ran during warm-up, possibly before self.picam2 was set
+            self._close_camera()
+            return
+        self.camera_ready.set()
+        self._set_state('running')
+        print(f"Motion detection started (camera warm-up {self.warmup_seconds:.1f}s, "
+              f"{'exposure settled' if settled else 'warm-up timed out'}).")
+        try:
+            self._detect_loop()
+        except Exception as e:
+            print(f"Motion detection failed: {e}")
+            self._fail(e)
+
+    def _fail(self, error):
+        """Release the camera and record the error, unless the failure came from stop()"""
+        stopping = not self.running
+        self.running = False
+        self.camera_ready.clear()
+        self._close_camera()
+        if not stopping:
+            self.error = str(error)
+            self._set_state('error')
+
+    def _close_camera(self):
+        picam2, self.picam2 = self.picam2, None
+        if picam2 is None:
+            return
+        try:
+            picam2.stop()
+            picam2.close()
+        except Exception as e:
+            print(f"Error closing camera: {e}")
+
+    def _wait_for_exposure(self):
+        """Block until auto-exposure has settled, returns False if the warm-up timed out"""
+        deadline = time.monotonic() + WARMUP_TIMEOUT_SECONDS
+        last = None
+        stable = 0
+        while self.running and time.monotonic() < deadline:
+            metadata = self.picam2.capture_metadata()
+            if metadata.get('AeLocked'):
+                return True
+            exposure = metadata.get('ExposureTime', 0) * metadata.get('AnalogueGain', 1.0)
+            if last and abs(exposure - last) <= WARMUP_SETTLE_TOLERANCE * last:
+                stable += 1
+                if stable >= WARMUP_SETTLE_FRAMES:
+                    return True
+            else:
+                stable = 0
+            last = exposure
+        return False
 
     def stop(self):
         self.running = False
-        if self.picam2:
-            self.picam2.stop()
+        self.camera_ready.clear()
+        picam2 = self.picam2
+        if picam2:
+            # Unblocks a capture in progress; the camera is closed once the thread has exited
+            picam2.stop()
         if self.thread:
             self.thread.join()
+        self._close_camera()
+        self._set_state('stopped')
         print("Motion detection stopped.")
 
+    def _set_state(self, state):
+        self.state = state
+        bus.publish('detector', state=state, error=self.error)
+
+    def _camera_available(self):
+        """True once the camera is warmed up, waiting out a warm-up that is still in progress"""
+        if self.state == 'warming_up':
+            self.camera_ready.wait(timeout=WARMUP_TIMEOUT_SECONDS * 2)
+        return self.camera_ready.is_set()
+
     def _detect_loop(self):
+        import cv2
         while self.running:
+            loop_started = time.monotonic()
             # Get current settings
             blur_size = get_setting('BLUR_KERNEL', 15)
             thresh_value = get_setting('THRESH_VALUE', 35)
             dilate_iterations = get_setting('DILATE_ITERATIONS', 2)
             contour_threshold = get_setting('CONTOUR_THRESHOLD', 300)
             cooldown = get_setting('MOTION_COOLDOWN_SECONDS', 5)
+            adaptive = get_setting('ADAPTIVE_THRESHOLD', False)
+            noise_frames = get_setting('NOISE_ADAPT_FRAMES', 50)
+            noise_sigma = get_setting('NOISE_SIGMA', 4.0)
             
             # Capture current frame
             frame2_yuv = self.picam2.capture_array("lores")
@@ -98,26 +260,136 @@ class MotionDetector:
             frame2 = cv2.GaussianBlur(frame2, (blur_size, blur_size), 0)
             # Compute the absolute difference
             frame_diff = cv2.absdiff(self.frame1, frame2)
-            thresh = cv2.threshold(frame_diff, thresh_value, 255, cv2.THRESH_BINARY)[1]
-            thresh = cv2.dilate(thresh, None, iterations=dilate_iterations)
-            # Find contours
-            contours, _ = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            motion_detected = any(cv2.contourArea(contour) > contour_threshold for contour in contours)
+            if adaptive:
+                motion_detected = self._detect_adaptive(frame_diff, frame2, thresh_value, dilate_iterations,
+                                                        contour_threshold, noise_frames, noise_sigma, cooldown)
+            else:
+                motion_detected = self._has_motion(frame_diff, thresh_value, dilate_iterations, contour_threshold)
+            self.loop_stats['frames'] += 1
+            self.loop_stats['busy_seconds'] += time.monotonic() - loop_started
             if motion_detected:
+                self.loop_stats['motion_events'] += 1
                 timestamp = time.strftime("%Y%m%d-%H%M%S")
                 filename = os.path.join(self.save_dir, f"motion_{timestamp}.jpg")
                 cv2.imwrite(filename, self.picam2.capture_array("main"))
                 print(f"Motion detected! Image saved as {filename}")
+                publish_file('capture', filename)
+                self._record_capture_size(filename)
                 time.sleep(cooldown)
             self.frame1 = frame2
             time.sleep(0.1)
 
+    def _has_motion(self, mask_or_diff, thresh_value, dilate_iterations, contour_threshold):
+        """Threshold a frame diff (or pass a ready binary mask with thresh_value=None) and look for large contours"""
+        import cv2
+        if thresh_value is None:
+            thresh = mask_or_diff
+        else:
+            thresh = cv2.threshold(mask_or_diff, thresh_value, 255, cv2.THRESH_BINARY)[1]
+        thresh = cv2.dilate(thresh, None, iterations=dilate_iterations)
+        # Find contours
+        contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        return any(cv2.contourArea(contour) > contour_threshold for contour in contours)
+
+    def _init_noise_model(self, shape):
+        """Allocate the running noise estimate and scratch buffers for the given frame shape"""
+        import numpy as np
+        self.noise_mean = np.zeros(shape, dtype=np.float32)
+        self.noise_var = np.zeros(shape, dtype=np.float32)
+        self.noise_frames_seen = 0
+        self._diff_f = np.empty(shape, dtype=np.float32)
+        self._delta = np.empty(shape, dtype=np.float32)
+        self._incr = np.empty(shape, dtype=np.float32)
+        self._threshold_map = np.empty(shape, dtype=np.float32)
+
+    def _detect_adaptive(self, frame_diff, gray, thresh_value, dilate_iterations, contour_threshold,
+                         noise_frames, noise_sigma, cooldown):
+        """Detect motion against a per-pixel threshold derived from the measured noise floor"""
+        import cv2
+        import numpy as np
+        if self.noise_mean is None or self.noise_mean.shape != frame_diff.shape:
+            self._init_noise_model(frame_diff.shape)
+        np.copyto(self._diff_f, frame_diff)
+        if self.noise_frames_seen == 0:
+            # Seed the floor from the first diff rather than from zero
+            np.copyto(self.noise_mean, self._diff_f)
+
+        # Effective threshold: max(brightness-scaled THRESH_VALUE, mean + sigma * std of the diff).
+        # Until the model has seen noise_frames frames it can't be trusted below THRESH_VALUE.
+        if self.noise_frames_seen < noise_frames:
+            base = thresh_value
+        else:
+            scale = float(np.mean(gray)) / ADAPTIVE_REFERENCE_BRIGHTNESS
+            base = thresh_value * min(1.0, max(ADAPTIVE_MIN_SCALE, scale))
+        # The variance starts at zero, so correct the EMA's bias towards it while it is young
+        rate = 1.0 / noise_frames
+        bias = 1.0 - (1.0 - rate) ** max(self.noise_frames_seen, 1)
+        np.sqrt(self.noise_var, out=self._threshold_map)
+        self._threshold_map *= noise_sigma / bias ** 0.5
+        self._threshold_map += self.noise_mean
+        np.maximum(self._threshold_map, base, out=self._threshold_map)
+        mask = cv2.compare(self._diff_f, self._threshold_map, cv2.CMP_GT)
+
+        # Learn from every frame, with the diff clipped to the current threshold so moving
+        # subjects only nudge the noise floor while a noisy start still converges
+        np.minimum(self._diff_f, self._threshold_map, out=self._diff_f)
+        self._update_noise_model(rate)
+        self.noise_frames_seen += 1
+
+        # Compare writes against a static-threshold detector with its own cooldown, both ways,
+        # so the savings reported are net and counted per image rather than per frame
+        stats = self.adaptive_stats
+        stats['frames'] += 1
+        static_write = False
+        now = time.monotonic()
+        if now >= self.static_cooldown_until and self._has_motion(frame_diff, thresh_value, dilate_iterations,
+                                                                 contour_threshold):
+            static_write = True
+            self.static_cooldown_until = now + cooldown
+        if self._has_motion(mask, None, dilate_iterations, contour_threshold):
+            stats['triggers'] += 1
+            if not static_write:
+                stats['adaptive_only_triggers'] += 1
+            return True
+        if static_write:
+            stats['false_triggers_avoided'] += 1
+        return False
+
+    def _update_noise_model(self, rate):
+        """Exponential moving mean and variance of the frame diff, updated in place"""
+        import numpy as np
+        np.subtract(self._diff_f, self.noise_mean, out=self._delta)
+        np.multiply(self._delta, rate, out=self._incr)
+        self.noise_mean += self._incr
+        # var = (1 - rate) * (var + delta * rate * delta)
+        self._delta *= self._incr
+        self.noise_var += self._delta
+        self.noise_var *= (1.0 - rate)
+
+    def _record_capture_size(self, filename):
+        """Keep a running average capture size to estimate the I/O saved by adaptive mode"""
+        try:
+            size = os.path.getsize(filename)
+        except OSError:
+            return
+        stats = self.adaptive_stats
+        avg = stats['avg_capture_bytes']
+        stats['avg_capture_bytes'] = size if avg == 0 else int(0.9 * avg + 0.1 * size)
+
+    def get_adaptive_stats(self):
+        """Counters for the adaptive threshold, including the estimated net bytes not written"""
+        stats = dict(self.adaptive_stats)
+        net_avoided = stats['false_triggers_avoided'] - stats['adaptive_only_triggers']
+        stats['bytes_avoided_estimate'] = net_avoided * stats['avg_capture_bytes']
+        return stats
+
     def capture_image(self):
         timestamp = time.strftime("%Y%m%d-%H%M%S")
         filename = os.path.join(self.save_dir, f"capture_{timestamp}.jpg")
-        if self.picam2:
+        if self._camera_available():
             self.picam2.capture_file(filename)
             print(f"Image captured: {filename}")
+            publish_file('capture', filename)
             cleanup_old_files(self.save_dir)
             return filename
         else:
@@ -125,10 +397,12 @@ class MotionDetector:
             return None
 
     def capture_timelapse(self):
+        import cv2
+        import numpy as np
         brightness_threshold = get_setting('TIMELAPSE_BRIGHTNESS_THRESHOLD', 40)
         print("Timelapse job triggered")
         # Grab a low-res frame and check brightness
-        if self.picam2:
+        if self._camera_available():
             try:
                 preview_yuv = self.picam2.capture_array("lores")
                 preview_color = cv2.cvtColor(preview_yuv, cv2.COLOR_YUV2RGB_I420)
@@ -142,6 +416,7 @@ class MotionDetector:
                 filename = os.path.join(self.timelapse_dir, f"timelapse_{timestamp}.jpg")
                 self.picam2.capture_file(filename)
                 print(f"Timelapse captured: {filename}")
+                publish_file('timelapse', filename, brightness=float(mean_brightness))
                 cleanup_old_files(self.timelapse_dir)
                 return {'success': True, 'filename': filename, 'brightness': mean_brightness}
             except Exception as e:
@@ -4,7 +4,7 @@ import os
 SAVE_DIR = os.getenv('SAVE_DIR', os.path.join(os.path.dirname(__file__), 'pictures'))
 
 # Timelapse directory
-TIME_LAPSE_DIR = os.path.join(os.path.dirname(__file__), 'timelapse')
+TIME_LAPSE_DIR = os.getenv('TIME_LAPSE_DIR', os.path.join(os.path.dirname(__file__), 'timelapse'))
 
 # Camera resolutions
 MAIN_RES = (2304, 1296)
@@ -1,14 +1,19 @@
-from flask import Flask, jsonify, send_from_directory, render_template, flash, redirect, url_for, request
+from flask import Flask, Response, abort, jsonify, send_from_directory, render_template, flash, redirect, url_for, request
 import importlib
+import io
 import sys
 import re
-from motion_detection import detector
+from motion_detection import detector, scheduler, publish_deleted
+from events import bus
+from history import history, METRICS as HISTORY_METRICS, TIERS as HISTORY_TIERS
+from archive import list_archived, read_archived, delete_archived
 import os
+import json
+import time
 import logging
 import shutil
 from datetime import datetime
 import subprocess
-import psutil
 from db_settings import get_all_settings, get_settings_by_category, get_setting, set_setting, reset_to_defaults
 
 app = Flask(__name__, template_folder='templates')
@@ -19,6 +24,148 @@ log = logging.getLogger('werkzeug')
 log.disabled = True
 app.logger.disabled = True
 
+# Server-sent events: a comment line every SSE_KEEPALIVE_SECONDS lets dead connections
+# be noticed
+SSE_KEEPALIVE_SECONDS = 15
+# Threads for page requests; event streams are greenlets and don't take one (see dispatch)
+WEB_POOL_THREADS = 10
+
+# journalctl output shown on /stats is reused for this long
+LOG_CACHE_SECONDS = 30
+log_cache = {'time': float('-inf'), 'lines': []}
+
+# Startup timing, filled in when the first response goes out
+startup = {'first_response_seconds': None}
+
+@app.after_request
+def record_first_response(response):
+    if startup['first_response_seconds'] is None:
+        import psutil
+        startup['first_response_seconds'] = time.time() - psutil.Process().create_time()
+        print(f"First response served {startup['first_response_seconds']:.2f}s after process start")
+    return response
+
+def component_status():
+    """Current state of the camera, detector and scheduler"""
+    detector_state = detector.state
+    if detector_state in ('warming_up', 'running') and not (detector.thread and detector.thread.is_alive()):
+        # The detector thread died without recording why
+        detector_state = 'error'
+    return {
+        'camera': 'ready' if detector.camera_ready.is_set() and detector_state == 'running' else detector_state,
+        'detector': detector_state,
+        'detector_error': detector.error,
+        'scheduler': 'running' if scheduler.running else 'stopped',
+        'camera_warmup_seconds': detector.warmup_seconds,
+        'first_response_seconds': startup['first_response_seconds'],
+    }
+
+def image_names(directory):
+    """Names of all images in directory, loose and archived, newest first"""
+    names = {f for f in os.listdir(directory) if f.endswith('.jpg')}
+    names.update(img['name'] for img in list_archived(directory))
+    return sorted(names, reverse=True)
+
+def send_image(directory, filename):
+    """Serve an image from disk, falling back to the day archives for compacted captures"""
+    if os.path.isfile(os.path.join(directory, filename)):
+        return send_from_directory(directory, filename)
+    data = read_archived(directory, filename)
+    if data is None:
+        abort(404)
+    return Response(data, mimetype='image/jpeg')
+
+def delete_file(directory, filename):
+    """Delete a loose or archived image, returns False if it does not exist"""
+    filepath = os.path.join(directory, filename)
+    if os.path.exists(filepath):
+        os.remove(filepath)
+    elif not delete_archived(directory, filename):
+        return False
+    publish_deleted(directory, filename)
+    return True
+
+def sse_message(event_type, data, event_id=None):
+    lines = [f"id: {event_id}"] if event_id is not None else []
+    lines += [f"event: {event_type}", f"data: {json.dumps(data)}"]
+    return '\n'.join(lines) + '\n\n'
+
+def dispatch(environ, start_response):
+    """WSGI entry point for the gevent server.
+
+    Event streams run as greenlets on the server's hub. Everything else blocks on disk,
+    sqlite and OpenCV, so it runs in the hub's thread pool; the response is collected
+    there and written out by the hub.
+    """
+    if environ.get('PATH_INFO') == '/events':
+        return app(environ, start_response)
+    from gevent import get_hub
+    # The connection belongs to the hub, so the request body is read before handing off
+    environ['wsgi.input'] = io.BytesIO(environ['wsgi.input'].read())
+
+    def handle():
+        response = app(environ, start_response)
+        try:
+            return list(response)
+        finally:
+            if hasattr(response, 'close'):
+                response.close()
+
+    return get_hub().threadpool.apply(handle)
+
+def make_server(host, port):
+    """The web server: gevent without monkey patching, so the camera and scheduler keep real threads"""
+    from gevent import get_hub
+    from gevent.pywsgi import WSGIServer
+    get_hub().threadpool.maxsize = WEB_POOL_THREADS
+    return WSGIServer((host, port), dispatch, log=None)
+
+# Live updates for the gallery pages: capture, timelapse, deleted and detector events
+@app.route('/events')
+def events():
+    # Resume after the last event the browser saw, or start from now
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    if last_id is None or last_id > bus.last_id:
+        last_id = bus.last_id
+
+    def stream(last_id):
+        from gevent import get_hub
+        from gevent.event import Event
+        # The bus wakes this greenlet through an async watcher, which is safe to send from
+        # the detector and pool threads; while idle the stream only costs the greenlet
+        woken = Event()
+        watcher = get_hub().loop.async_()
+        watcher.start(woken.set)
+        try:
+            with bus.subscribe(watcher.send):
+                yield 'retry: 5000\n\n'
+                yield sse_message('detector', {'state': detector.state, 'error': detector.error})
+                while True:
+                    woken.clear()
+                    pending = bus.since(last_id)
+                    for event_id, event_type, data in pending:
+                        last_id = event_id
+                        yield sse_message(event_type, data, event_id)
+                    if not pending and not woken.wait(SSE_KEEPALIVE_SECONDS):
+                        yield ': keepalive\n\n'
+        finally:
+            watcher.close()
+
+    return Response(stream(last_id), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Liveness: the web server is up
+@app.route('/healthz')
+def healthz():
+    return jsonify({'status': 'ok', **component_status()})
+
+# Readiness: camera warmed up, detector and scheduler running
+@app.route('/readyz')
+def readyz():
+    status = component_status()
+    ready = status['camera'] == 'ready' and status['detector'] == 'running' and status['scheduler'] == 'running'
+    return jsonify({'ready': ready, **status}), 200 if ready else 503
+
 # API: Get all settings
 @app.route('/api/settings', methods=['GET'])
 def api_get_settings():
@@ -55,6 +202,12 @@ def api_reset_settings():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+# API: Adaptive threshold counters
+@app.route('/api/detector/stats', methods=['GET'])
+def api_detector_stats():
+    """Get adaptive threshold counters (false triggers avoided and estimated bytes saved)"""
+    return jsonify({'success': True, 'adaptive': detector.get_adaptive_stats()})
+
 # Settings page
 @app.route('/settings', methods=['GET', 'POST'])
 def settings_page():
@@ -68,8 +221,13 @@ def settings_page():
                 reset_to_defaults()
                 message = 'All settings reset to defaults!'
             else:
-                # Update individual settings
-                for key, value in request.form.items():
+                # Update individual settings. Unchecked checkboxes are not submitted, so
+                # bool settings missing from the form are switched off.
+                values = dict(request.form.items())
+                for key, meta in get_all_settings().items():
+                    if meta['data_type'] == 'bool' and key not in values:
+                        values[key] = 'false'
+                for key, value in values.items():
                     if key != 'csrf_token':  # Skip CSRF token if present
                         try:
                             set_setting(key, value)
@@ -102,7 +260,7 @@ def index():
     images.sort(key=lambda x: x['mtime'], reverse=True)  # Newest first
     images = images[:25]  # Limit to 25 most recent images
     free_space = shutil.disk_usage('/').free / (1024**3)  # Free space in GB
-    return render_template('index.html', images=images, free_space=free_space)
+    return render_template('index.html', images=images, free_space=free_space, detector_state=detector.state)
 
 @app.route('/timelapse')
 def timelapse():
@@ -163,7 +321,7 @@ def capture_timelapse_now():
 @app.route('/timelapse/<filename>')
 def view_timelapse_image(filename):
     # Get all timelapse images sorted by name (newest first)
-    images = sorted([f for f in os.listdir(detector.timelapse_dir) if f.endswith('.jpg')], reverse=True)
+    images = image_names(detector.timelapse_dir)
     current_index = images.index(filename) if filename in images else -1
     prev_image = images[current_index - 1] if current_index > 0 else None
     next_image = images[current_index + 1] if current_index < len(images) - 1 else None
@@ -171,12 +329,12 @@ def view_timelapse_image(filename):
 
 @app.route('/timelapse_image/<filename>')
 def get_timelapse_image(filename):
-    return send_from_directory(detector.timelapse_dir, filename)
+    return send_image(detector.timelapse_dir, filename)
 
 @app.route('/view/<filename>')
 def view_image(filename):
     # Get all motion images sorted by name (newest first)
-    images = sorted([f for f in os.listdir(detector.save_dir) if f.endswith('.jpg')], reverse=True)
+    images = image_names(detector.save_dir)
     current_index = images.index(filename) if filename in images else -1
     prev_image = images[current_index - 1] if current_index > 0 else None
     next_image = images[current_index + 1] if current_index < len(images) - 1 else None
@@ -202,21 +360,18 @@ def stop():
 
 @app.route('/images')
 def list_images():
-    save_dir = detector.save_dir
-    images = [f for f in os.listdir(save_dir) if f.endswith('.jpg')]
-    images.sort(reverse=True)  # Sort by name descending (newest first, assuming timestamped names)
+    # Sorted by name descending (newest first, assuming timestamped names), archived images included
+    images = image_names(detector.save_dir)
     return render_template('images.html', images=images)
 
 @app.route('/images/<filename>')
 def get_image(filename):
-    return send_from_directory(detector.save_dir, filename)
+    return send_image(detector.save_dir, filename)
 
 @app.route('/delete/<filename>', methods=['POST'])
 def delete_image(filename):
     try:
-        filepath = os.path.join(detector.save_dir, filename)
-        if os.path.exists(filepath):
-            os.remove(filepath)
+        if delete_file(detector.save_dir, filename):
             flash(f"Deleted {filename}")
         else:
             flash(f"File {filename} not found")
@@ -227,9 +382,7 @@ def delete_image(filename):
 @app.route('/delete_timelapse/<filename>', methods=['POST'])
 def delete_timelapse(filename):
     try:
-        filepath = os.path.join(detector.timelapse_dir, filename)
-        if os.path.exists(filepath):
-            os.remove(filepath)
+        if delete_file(detector.timelapse_dir, filename):
             flash(f"Deleted {filename}")
         else:
             flash(f"File {filename} not found")
@@ -237,8 +390,26 @@ def delete_timelapse(filename):
         flash(f"Error deleting {filename}: {str(e)}")
     return redirect(url_for('timelapse'))
 
+# API: Detector and system stats history
+@app.route('/api/stats/history', methods=['GET'])
+def api_stats_history():
+    """Get one retention tier of the stats history, optionally since a unix timestamp"""
+    tier = request.args.get('tier', 'minute')
+    tiers = {name: bucket for name, bucket, _ in HISTORY_TIERS}
+    if tier not in tiers:
+        return jsonify({'success': False, 'error': f"Unknown tier: {tier}"}), 400
+    since = request.args.get('since', type=float)
+    return jsonify({
+        'success': True,
+        'tier': tier,
+        'bucket_seconds': tiers[tier],
+        'columns': ['time'] + [name for name, _ in HISTORY_METRICS],
+        'points': history.query(tier, since),
+    })
+
 @app.route('/stats')
 def stats():
+    import psutil
     # Get process information
     try:
         current_process = psutil.Process()
@@ -248,53 +419,46 @@ def stats():
     except:
         uptime_str = "Unknown"
     
-    # Count files in directories
-    motion_count = len([f for f in os.listdir(detector.save_dir) if f.endswith('.jpg')])
-    timelapse_count = len([f for f in os.listdir(detector.timelapse_dir) if f.endswith('.jpg')])
-    
-    # Get disk space
-    free_space_gb = shutil.disk_usage('/').free / (1024**3)
-    total_space_gb = shutil.disk_usage('/').total / (1024**3)
+    # Counts, sizes and disk space come from the last history sample instead of rescanning
+    snapshot = history.latest or history.sample()
+    free_space_gb = snapshot['free_space_gb']
+    total_space_gb = snapshot['total_space_gb']
     used_space_gb = total_space_gb - free_space_gb
     
-    # Calculate directory sizes
-    try:
-        motion_size = sum(os.path.getsize(os.path.join(detector.save_dir, f)) 
-                         for f in os.listdir(detector.save_dir) if f.endswith('.jpg')) / (1024**2)
-        timelapse_size = sum(os.path.getsize(os.path.join(detector.timelapse_dir, f)) 
-                            for f in os.listdir(detector.timelapse_dir) if f.endswith('.jpg')) / (1024**2)
-    except:
-        motion_size = 0
-        timelapse_size = 0
-    
-    # Get recent logs (last 50 lines)
-    try:
-        result = subprocess.run(['journalctl', '-u', 'pimocam', '-n', '50', '--no-pager'], 
-                               capture_output=True, text=True, timeout=5)
-        logs = result.stdout.split('\n')
-    except:
-        logs = ["Could not retrieve logs"]
+    # Get recent logs (last 50 lines), cached briefly so page reloads don't spawn journalctl each time
+    if time.monotonic() - log_cache['time'] > LOG_CACHE_SECONDS:
+        try:
+            result = subprocess.run(['journalctl', '-u', 'pimocam', '-n', '50', '--no-pager'], 
+                                   capture_output=True, text=True, timeout=5)
+            log_cache['lines'] = result.stdout.split('\n')
+        except:
+            log_cache['lines'] = ["Could not retrieve logs"]
+        log_cache['time'] = time.monotonic()
+    logs = log_cache['lines']
     
     # Get current settings
     settings = get_all_settings()
     
     stats_data = {
         'uptime': uptime_str,
-        'motion_count': motion_count,
-        'timelapse_count': timelapse_count,
-        'motion_size_mb': motion_size,
-        'timelapse_size_mb': timelapse_size,
+        'motion_count': snapshot['motion']['count'],
+        'timelapse_count': snapshot['timelapse']['count'],
+        'motion_size_mb': snapshot['motion']['size_mb'],
+        'timelapse_size_mb': snapshot['timelapse']['size_mb'],
+        'sampled_at': snapshot['time'],
+        'current': snapshot['values'],
         'free_space_gb': free_space_gb,
         'used_space_gb': used_space_gb,
         'total_space_gb': total_space_gb,
         'logs': logs,
-        'settings': settings
+        'settings': settings,
+        'adaptive': detector.get_adaptive_stats()
     }
     
     return render_template('stats.html', stats=stats_data)
 
 if __name__ == '__main__':
-    from motion_detection import scheduler
+    from history import SAMPLE_INTERVAL_SECONDS
     from settings import WEBSERVER_HOST
     from db_settings import get_setting
     print("Starting detector...")
@@ -302,6 +466,7 @@ if __name__ == '__main__':
     print("Adding timelapse job...")
     interval_minutes = get_setting('SCHEDULER_INTERVAL_MINUTES', 30)
     scheduler.add_job(func=lambda: detector.capture_timelapse(), trigger="interval", minutes=interval_minutes)
+    scheduler.add_job(func=history.sample, trigger="interval", seconds=SAMPLE_INTERVAL_SECONDS, next_run_time=datetime.now())
     print("Starting scheduler...")
     scheduler.start()
     print("Starting webserver...")